@@ -2,6 +2,7 @@ from random import choice, seed
 import pandas as pd
 
 from string_manipulation import augment
+from note_store import load_note_store, note_text, read_note_metadata
 import random
 import re
 import logging
@@ -15,18 +16,30 @@ logger = logging.getLogger(__name__)
 _df = pd.core.frame.DataFrame
 
 
-def augment_row_syn(row_id:int, text_df:_df, semehr_df:_df, augmemtation_prob=1):
+def new_row_and_text(row_id:int, text_df:_df, note_store:tuple=None)->tuple:
+    """
+    Returns the row of the text dataframe identified by a row_id prepared for receiving a new TEXT, along with the original text of the discharge summary.
+    If a note store (see note_store.py) is provided, the text is read from the shared memory-mapped store, and the TEXT column of the text dataframe only needs to hold
+    placeholders keeping its position (see read_note_metadata).
+    """
+    # take already returns a new frame (not flagged as a view of text_df), so the row can receive the new TEXT without a further copy.
+    new_row = text_df.take((text_df["ROW_ID"]==row_id).to_numpy().nonzero()[0])
+    if note_store is None:
+        return new_row, list(new_row.TEXT)[0]
+    return new_row, note_text(row_id, note_store)
+
+def augment_row_syn(row_id:int, text_df:_df, semehr_df:_df, augmemtation_prob=1, note_store:tuple=None, row_and_text:tuple=None):
     """
     Given a row ID of a discharge summary, the dataframe containing the discharge summaries, the dataframe of NER+L output (e.g, from semehr) reformatted with synonyms, and conversion of CUI to ICD9, and the probability with which each mention should be used for augmentation produces a new row with augmented text (with replacement synonyms) with the untouched gold standard.
+    The output of new_row_and_text can be passed as row_and_text if it has already been retrieved.
     """
     mentions = semehr_df[semehr_df["row_id"]==row_id][["CUI", "string", "start_offset", "end_offset", "synonyms", "ICD9"]]
-    original_row = text_df[text_df["ROW_ID"]==row_id]
-
-    new_row = original_row.copy()
-    # retrieve the original labels provided by the gold standard.
-    labels = str(list(original_row["LABELS"])[0]).split(";")
     # retrieve the original text of the discharge summary.
-    old_text = list(new_row.TEXT)[0]
+    if row_and_text is None:
+        row_and_text = new_row_and_text(row_id, text_df, note_store)
+    new_row, old_text = row_and_text
+    # retrieve the original labels provided by the gold standard.
+    labels = str(list(new_row["LABELS"])[0]).split(";")
     # initialise lists for the slices of interest and replacement code candidates.
     slices = []
     replacement_candidates = []
@@ -52,10 +65,10 @@ def augment_row_syn(row_id:int, text_df:_df, semehr_df:_df, augmemtation_prob=1)
                     replacement_candidates.append(replacement_text)
                     
     # execute the augmentation, replace the TEXT in the new row, return the row.
-    new_row.TEXT = augment(old_text, slices, replacement_candidates)
+    new_row["TEXT"] = augment(old_text, slices, replacement_candidates)
     return(new_row)
 
-def augment_all_rows_syn(intext:_df, semehr_output:_df)->_df:
+def augment_all_rows_syn(intext:_df, semehr_output:_df, note_store:tuple=None)->_df:
     """
     Given a dataframe of discharge summaries, and their corresponding output of NER+L runs augmentation through synonyms on the whole dataframe.
     """
@@ -63,22 +76,24 @@ def augment_all_rows_syn(intext:_df, semehr_output:_df)->_df:
     new_rows = []
     counter = 0
     for id, row in tqdm(intext.iterrows()):
-        new_row = augment_row_syn(row["ROW_ID"], intext, semehr_output)
+        row_and_text = new_row_and_text(row["ROW_ID"], intext, note_store)
+        old_text = row_and_text[1]
+        new_row = augment_row_syn(row["ROW_ID"], intext, semehr_output, row_and_text=row_and_text)
 
-        if new_row['TEXT'].iloc[0].lower().strip() != row.TEXT.lower().strip():
+        if new_row['TEXT'].iloc[0].lower().strip() != old_text.lower().strip():
             counter+=1
         new_rows.append(new_row)
     logger.info(f'{counter} augmented rows')
     new_rows = pd.concat(new_rows)
     return new_rows
     
-def run_augmentations(orignal_texts_df:_df, traditional_method_results:list)->_df:
+def run_augmentations(orignal_texts_df:_df, traditional_method_results:list, note_store:tuple=None)->_df:
     """
     Runs the synonym augmentation using outputs of different NER+L methods.
     """
     augmented_texts = []
     for single_method_results in traditional_method_results:
-        augmented_texts.append(augment_all_rows_syn(orignal_texts_df, medcat_results))
+        augmented_texts.append(augment_all_rows_syn(orignal_texts_df, single_method_results, note_store))
     combined = pd.concat(augmented_texts)
     return combined
 
@@ -162,20 +177,21 @@ def find_unspecifieds(convs:_df)->list:
     unspecifieds = [u for u in unspecifieds if pat.match(u) is not None]
     return unspecifieds
 
-def synth_row_adj(row_id:int, text_df:_df, semehr_df:_df, conversion_df:_df, synonym_df:_df, unspecs:list):
+def synth_row_adj(row_id:int, text_df:_df, semehr_df:_df, conversion_df:_df, synonym_df:_df, unspecs:list, note_store:tuple=None, row_and_text:tuple=None):
     """
     Performs synthesis on a document in the text dataframe identified by a row_id.
+    The output of new_row_and_text can be passed as row_and_text if it has already been retrieved.
     """
     mentions = semehr_df[semehr_df["row_id"]==row_id][["CUI", "string", "start_offset", "end_offset", "synonyms", "ICD9"]]
     
-    original_row = text_df[text_df["ROW_ID"]==row_id]
-    new_row = original_row.copy()
+    if row_and_text is None:
+        row_and_text = new_row_and_text(row_id, text_df, note_store)
+    new_row, old_text = row_and_text
     
-    labels = str(list(original_row["LABELS"])[0]).strip().split(";")
+    labels = str(list(new_row["LABELS"])[0]).strip().split(";")
     original_labels = set(labels)
     label_map = convert_labels(labels, conversion_df, unspecs)
     
-    old_text = list(new_row.TEXT)[0]
     slices = []
     adjusted_labels = set()
     replacement_candidates = []
@@ -191,7 +207,7 @@ def synth_row_adj(row_id:int, text_df:_df, semehr_df:_df, conversion_df:_df, syn
                 replacement_candidates.append(replacement_candidate)
             adjusted_labels.add(row.ICD9)
     if replacement_candidates != []:
-        new_row.TEXT = augment(old_text, slices, replacement_candidates)
+        new_row["TEXT"] = augment(old_text, slices, replacement_candidates)
         untouched_labels = original_labels.difference(adjusted_labels)
         new_labels = set([label_map[label] for label in adjusted_labels])
         new_label_set = untouched_labels.union(new_labels)
@@ -200,7 +216,7 @@ def synth_row_adj(row_id:int, text_df:_df, semehr_df:_df, conversion_df:_df, syn
         return(new_row)
     return None
     
-def synth_all_rows_adj(intext:_df, semehr_output:_df, conversion_df:_df, synonym_df:_df)->_df:
+def synth_all_rows_adj(intext:_df, semehr_output:_df, conversion_df:_df, synonym_df:_df, note_store:tuple=None)->_df:
     """
     Performs the adjacent-code synthesis on a full dataset.
     """
@@ -208,16 +224,18 @@ def synth_all_rows_adj(intext:_df, semehr_output:_df, conversion_df:_df, synonym
     counter = 0
     unspecs = find_unspecifieds(conversion_df)
     for id, row in tqdm(intext.iterrows()):
-        new_row = synth_row_adj(row["ROW_ID"], intext, semehr_output, conversion_df, synonym_df, unspecs)
+        row_and_text = new_row_and_text(row["ROW_ID"], intext, note_store)
+        old_text = row_and_text[1]
+        new_row = synth_row_adj(row["ROW_ID"], intext, semehr_output, conversion_df, synonym_df, unspecs, row_and_text=row_and_text)
         if new_row is not None:
-            if new_row['TEXT'].iloc[0].lower().strip() != row.TEXT.lower().strip():
+            if new_row['TEXT'].iloc[0].lower().strip() != old_text.lower().strip():
                 counter+=1
             new_rows.append(new_row)
     logger.info(f'{counter} synthetic rows')
     new_rows = pd.concat(new_rows)
     return new_rows
     
-def run_synthesis_adj(orignal_texts_df:_df, traditional_method_results:list, conversion_df:_df, synonym_df:_df, iters =2)->_df:
+def run_synthesis_adj(orignal_texts_df:_df, traditional_method_results:list, conversion_df:_df, synonym_df:_df, iters =2, note_store:tuple=None)->_df:
     """
     Runs the whole synthesis pipeline over multiple iterations -- as there is randomness involved in choices of codes and of the replacement text for each mention, the same document can yield 
     multiple viable synths. Duplicates are dropped.
@@ -226,10 +244,135 @@ def run_synthesis_adj(orignal_texts_df:_df, traditional_method_results:list, con
     augmented_texts = []
     for single_method_results in traditional_method_results:
         for _ in range(iters):
-            augmented_texts.append(synth_all_rows_adj(orignal_texts_df, medcat_results, conversion_df, synonym_df))
+            augmented_texts.append(synth_all_rows_adj(orignal_texts_df, single_method_results, conversion_df, synonym_df, note_store))
     combined = pd.concat(augmented_texts).drop_duplicates()
     return combined
     
+def shot_codes(conversion_df:_df, codeset:str)->set:
+    """
+    Collects the codes of a code subset (``zero'' or ``few'') that appear as viable siblings in the conversion table (from adjacent_setup.py).
+    """
+    assert codeset in ["normal", "few", "zero"]
+    codes = set()
+    for alts in conversion_df[codeset]:
+        if str(alts) != "nan" and alts != "":
+            codes.update(alts.split("|"))
+    return codes
+
+def build_quotas(text_df:_df, codes:set, target:int)->dict:
+    """
+    Sets up per-code synthesis quotas -- given the dataframe of discharge summaries, a set of codes (e.g., the zero-shot and few-shot codes from derive_sets) and a target count,
+    returns how many synthetic documents are still needed for each code to appear in at least target documents. Codes already meeting the target are left out.
+    """
+    counts = dict.fromkeys(codes, 0)
+    for label_list in text_df.LABELS:
+        for label in set(str(label_list).strip().split(";")):
+            if label in counts:
+                counts[label] += 1
+    return {code: target-count for code, count in counts.items() if count < target}
+
+def schedule_synthesis(text_df:_df, semehr_df:_df, conversion_df:_df, synonym_df:_df, quotas:dict, unspecs:list, scheduled_pairs:set=None)->tuple:
+    """
+    Picks the (document, unspecified code, replacement code) triples to synthesise in order to fill the quotas. A triple is viable if the unspecified code is both a gold label and
+    a mention of the document, and the replacement is a zero-shot/few-shot sibling of it with synonyms available. Viable triples are visited in random order and each one is
+    scheduled only while its replacement code still needs documents, stopping as soon as all quotas are met.
+    A document is synthesised at most once per replacement code (even if it mentions several unspecified siblings of it) -- the (document, replacement code) pairs already
+    scheduled, e.g. using the output of another NER+L method, are passed in scheduled_pairs, which is updated with the newly scheduled pairs.
+    Returns the scheduled triples and the quotas left unmet.
+    """
+    remaining = {code: quota for code, quota in quotas.items() if quota > 0}
+    if scheduled_pairs is None:
+        scheduled_pairs = set()
+    synonym_codes = set(synonym_df.dropna().LABEL)
+    unspecs = set(unspecs)
+
+    # replacement candidates for every unspecified code, restricted to the codes we still need.
+    conversion = conversion_df.drop_duplicates("code").set_index("code")
+    replacements = dict()
+    for code in unspecs.intersection(conversion.index):
+        candidates = set()
+        for codeset in ["zero", "few"]:
+            alts = conversion.loc[code, codeset]
+            if str(alts) != "nan" and alts != "":
+                candidates.update(alts.split("|"))
+        candidates = [c for c in candidates if c in remaining and c in synonym_codes]
+        if candidates != []:
+            replacements[code] = sorted(candidates)
+
+    labels = dict(zip(text_df.ROW_ID, [set(str(l).strip().split(";")) for l in text_df.LABELS]))
+    mentioned = semehr_df[semehr_df["ICD9"].isin(replacements.keys())][["row_id", "ICD9"]].drop_duplicates()
+
+    triples = []
+    for row_id, code in zip(mentioned.row_id, mentioned.ICD9):
+        if row_id in labels and code in labels[row_id]:
+            for replacement in replacements[code]:
+                if replacement not in labels[row_id]:
+                    triples.append((row_id, code, replacement))
+    random.shuffle(triples)
+
+    scheduled = []
+    unmet = len(remaining)
+    for row_id, code, replacement in triples:
+        if unmet == 0:
+            break
+        if remaining[replacement] > 0 and (row_id, replacement) not in scheduled_pairs:
+            scheduled.append((row_id, code, replacement))
+            scheduled_pairs.add((row_id, replacement))
+            remaining[replacement] -= 1
+            if remaining[replacement] == 0:
+                unmet -= 1
+    logger.info(f'{len(scheduled)} synths scheduled out of {len(triples)} viable triples, {unmet} quotas unmet')
+    return scheduled, {code: quota for code, quota in remaining.items() if quota > 0}
+
+def synth_row_scheduled(row_id:int, code:str, replacement:str, text_df:_df, semehr_df:_df, synonym_df:_df, note_store:tuple=None):
+    """
+    Performs synthesis on a document for a single scheduled triple -- the mentions of the unspecified code are replaced with synonyms of the replacement code,
+    and the code is swapped for the replacement in the gold standard. Expects a triple picked by schedule_synthesis, i.e. the code is mentioned in the document
+    and the replacement has synonyms available.
+    """
+    mentions = semehr_df[(semehr_df["row_id"]==row_id) & (semehr_df["ICD9"]==code)].sort_values("start_offset")
+    new_row, old_text = new_row_and_text(row_id, text_df, note_store)
+    labels = set(str(list(new_row["LABELS"])[0]).strip().split(";"))
+
+    slices = []
+    replacement_candidates = []
+    for x, row in mentions.iterrows():
+        replacement_candidate = synonym_lookup(replacement, synonym_df)
+        assert replacement_candidate is not None, f"no synonyms for scheduled replacement {replacement}"
+        slices.append((row["start_offset"], row["end_offset"]))
+        replacement_candidates.append(replacement_candidate)
+    assert slices != [], f"scheduled code {code} is not mentioned in document {row_id}"
+    new_row["TEXT"] = augment(old_text, slices, replacement_candidates)
+    labels.discard(code)
+    labels.add(replacement)
+    new_row["LABELS"] = ";".join(labels)
+    return new_row
+
+def run_synthesis_quota(orignal_texts_df:_df, traditional_method_results:list, conversion_df:_df, synonym_df:_df, quotas:dict, note_store:tuple=None)->_df:
+    """
+    Runs quota-driven synthesis -- rather than synthesising over the whole corpus, only the triples picked by schedule_synthesis are generated, until each code in quotas
+    has received its number of synthetic documents. Quotas filled using the output of one NER+L method are not revisited for the following ones, and a (document, replacement code)
+    pair synthesised using one method is not synthesised again using another.
+    """
+    logger.info(f'Initiating Quota Synthesis.')
+    unspecs = find_unspecifieds(conversion_df)
+    synth_texts = []
+    scheduled_pairs = set()
+    for single_method_results in traditional_method_results:
+        scheduled, quotas = schedule_synthesis(orignal_texts_df, single_method_results, conversion_df, synonym_df, quotas, unspecs, scheduled_pairs)
+        for row_id, code, replacement in tqdm(scheduled):
+            synth_texts.append(synth_row_scheduled(row_id, code, replacement, orignal_texts_df, single_method_results, synonym_df, note_store))
+        if quotas == {}:
+            break
+    logger.info(f'{len(synth_texts)} synthetic rows, {len(quotas)} quotas unmet')
+    if synth_texts == []:
+        # an empty frame with the columns of the synthetic rows, which always hold a TEXT column.
+        empty = orignal_texts_df.iloc[0:0].copy()
+        if "TEXT" not in empty.columns:
+            empty["TEXT"] = pd.Series(dtype=object)
+        return empty
+    return pd.concat(synth_texts)
+    
     
 if __name__ == "__main__":
     
@@ -242,7 +385,15 @@ if __name__ == "__main__":
     syn_df = pd.read_csv(synonym_path)
     conv_df = pd.read_csv(conversion_path)
     
-    texts = pd.read_csv(MIMIC_DIR+"train_full_raw_wlabels.csv")
+    # Optionally, set the path to a note store built once from train_full_raw_wlabels.csv (see note_store.py) -- the texts are then read from the shared memory map.
+    # Worker processes cannot be handed the opened store, each of them needs to call load_note_store itself.
+    note_store_path = None
+    if note_store_path is None:
+        notes = None
+        texts = pd.read_csv(MIMIC_DIR+"train_full_raw_wlabels.csv")
+    else:
+        texts = read_note_metadata(MIMIC_DIR+"train_full_raw_wlabels.csv")
+        notes = load_note_store(note_store_path, texts.ROW_ID)
     print('texts read')
     
     semehr_results_path = "/path/to/semehr/results.csv"
@@ -262,8 +413,8 @@ if __name__ == "__main__":
     print('Augmentation')
     
     # Augmentation through synonyms
-    semehr_augmented_texts = run_augmentations(texts, [semehr_results])
-    medcat_augmented_texts = run_augmentations(texts, [medcat_results])
+    semehr_augmented_texts = run_augmentations(texts, [semehr_results], notes)
+    medcat_augmented_texts = run_augmentations(texts, [medcat_results], notes)
     
     medcat_augmented_texts.to_csv(AUG_FOLDER_RAW+"train_medcat_augmented_full_raw.csv",index=False)
     semehr_augmented_texts.to_csv(AUG_FOLDER_RAW+"train_semehr_augmented_full_raw.csv",index=False)
@@ -271,11 +422,19 @@ if __name__ == "__main__":
     print('Synthesis')
     
     # Synthesis with adjacent codes
-    semehr_synth_texts = run_synthesis_adj(texts, [semehr_results], conv_df, syn_df, iters = 1)
-    medcat_synth_texts = run_synthesis_adj(texts, [medcat_results], conv_df, syn_df, iters = 1)
+    semehr_synth_texts = run_synthesis_adj(texts, [semehr_results], conv_df, syn_df, iters = 1, note_store = notes)
+    medcat_synth_texts = run_synthesis_adj(texts, [medcat_results], conv_df, syn_df, iters = 1, note_store = notes)
     
     
     # Saving
     medcat_synth_texts.to_csv(AUG_FOLDER_RAW+"train_medcat_synthetic_full_raw.csv",index=False)
     semehr_synth_texts.to_csv(AUG_FOLDER_RAW+"train_semehr_synthetic_full_raw.csv",index=False)
     
+    print('Quota synthesis')
+    
+    # Synthesis targeting the zero-shot and few-shot codes only, stopping once each of them appears in at least 10 documents
+    target = 10
+    quotas = build_quotas(texts, shot_codes(conv_df, "zero").union(shot_codes(conv_df, "few")), target)
+    quota_synth_texts = run_synthesis_quota(texts, [semehr_results, medcat_results], conv_df, syn_df, quotas, note_store = notes)
+    quota_synth_texts.to_csv(AUG_FOLDER_RAW+"train_quota_synthetic_full_raw.csv",index=False)
+    
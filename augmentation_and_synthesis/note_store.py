@@ -0,0 +1,86 @@
+"""
+A note store for sharing the texts of discharge summaries between processes: the notes are UTF-8 encoded into a single blob, memory-mapped read-only, and located through
+an index of byte offsets keyed by ROW_ID. As the NER+L offsets refer to characters rather than bytes, each note is decoded on access and splicing works on the decoded copy.
+"""
+import mmap
+import os
+import pandas as pd
+
+_df = pd.core.frame.DataFrame
+
+
+def build_note_store(texts_df:_df, store_path:str)->_df:
+    """
+    Builds a note store from a dataframe of discharge summaries -- the TEXT of every note is UTF-8 encoded and concatenated into a single blob (store_path),
+    while the byte offsets of each note are kept in an index keyed by ROW_ID (store_path + ".idx.csv"). Returns the index dataframe.
+    """
+    row_ids = []
+    starts = []
+    ends = []
+    offset = 0
+    with open(store_path, "wb") as blob:
+        for row_id, text in zip(texts_df.ROW_ID, texts_df.TEXT):
+            # missing notes are stored as empty texts rather than as the string "nan".
+            text = "" if pd.isna(text) else str(text)
+            encoded = text.encode("utf-8")
+            blob.write(encoded)
+            row_ids.append(row_id)
+            starts.append(offset)
+            offset += len(encoded)
+            ends.append(offset)
+    index_df = pd.DataFrame({"ROW_ID":row_ids, "start":starts, "end":ends})
+    index_df.to_csv(store_path + ".idx.csv", index=False)
+    return index_df
+
+def load_note_store(store_path:str, row_ids:list=None)->tuple:
+    """
+    Opens a note store created by build_note_store. The blob is memory-mapped read-only, so all processes opening the same store share the same page cache.
+    Returns a tuple of the memory map and a dictionary mapping ROW_ID to the (start, end) byte offsets of the note. The memory map cannot be pickled -- rather than
+    passing the store to worker processes, each worker should call load_note_store itself (e.g., in a multiprocessing.Pool initializer).
+    If row_ids (e.g., the ROW_ID column of the CSV the store is used with) are given, checks that the store holds exactly these notes.
+    """
+    index_df = pd.read_csv(store_path + ".idx.csv")
+    offsets = dict(zip(index_df.ROW_ID, zip(index_df.start, index_df.end)))
+    if row_ids is not None:
+        row_ids = set(row_ids)
+        missing = row_ids.difference(offsets)
+        extra = set(offsets).difference(row_ids)
+        if missing or extra or len(offsets) != len(index_df):
+            raise ValueError(f"Note store {store_path} does not match the given ROW_IDs: {len(missing)} missing, {len(extra)} unexpected, "
+                             f"{len(index_df) - len(offsets)} duplicated. Rebuild it with build_note_store from the same CSV.")
+    # empty files cannot be memory-mapped, a store of empty (or no) notes needs no mapping.
+    if os.path.getsize(store_path) == 0:
+        return b"", offsets
+    with open(store_path, "rb") as blob:
+        # the mapping stays valid after the file object is closed.
+        note_map = mmap.mmap(blob.fileno(), 0, access=mmap.ACCESS_READ)
+    return note_map, offsets
+
+def read_note_metadata(csv_path:str)->_df:
+    """
+    Reads a CSV of discharge summaries without loading the note texts -- the TEXT column is kept in its original position, holding empty placeholders,
+    so that rows built with texts from the note store have the same columns as rows built from the full CSV.
+    """
+    columns = list(pd.read_csv(csv_path, nrows=0).columns)
+    texts_df = pd.read_csv(csv_path, usecols=lambda column: column != "TEXT")
+    if "TEXT" in columns:
+        texts_df.insert(columns.index("TEXT"), "TEXT", "")
+    return texts_df
+
+def note_text(row_id:int, note_store:tuple)->str:
+    """
+    Returns the decoded text of the note identified by row_id.
+    """
+    note_map, offsets = note_store
+    start, end = offsets[row_id]
+    # decoding straight from a view of the mapping avoids an intermediate copy of the bytes.
+    return str(memoryview(note_map)[start:end], "utf-8")
+
+
+if __name__ == "__main__":
+    MIMIC_DIR = "/path/to/mimic/dir/"
+    store_path = "/path/to/notes.bin"
+
+    texts = pd.read_csv(MIMIC_DIR+"train_full_raw_wlabels.csv")
+    index = build_note_store(texts, store_path)
+    print(f'{len(index)} notes stored')
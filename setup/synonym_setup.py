@@ -2,12 +2,16 @@ from owlready2 import *
 from owlready2.pymedtermino2 import *
 from owlready2.pymedtermino2.umls import *
 import pandas as pd
+import multiprocessing
+import time
+from tqdm import tqdm
 
 
 # load up UMLS, create a pymedtermino world, populate it with desired ontologies (here ICD9CM, ICD10, SNOMEDCT_US, CUT)
 umls_path = "path/to/umls/folder/" 
 
-default_world.set_backend(filename = "pym.sqlite3")
+# the backend is not exclusive, so that worker processes of the parallel setup can open their own read-only connections (see syndf_setup)
+default_world.set_backend(filename = "pym.sqlite3", exclusive = False)
 import_umls(umls_path+"umls-2021AA-full.zip", terminologies = ["ICD9CM","ICD10", "SNOMEDCT_US","CUI"])
 default_world.save()
 
@@ -107,23 +111,73 @@ def set_up_synonyms_ICD9(icd9:str, drop_unspecified:bool = True)->list:
             syn_result.append((concept.name, res))
     return syn_result
 
-def syndf_setup(data_df:pd.core.frame.DataFrame)->pd.core.frame.DataFrame:
+def resolve_labels(labels:list, drop_unspecified:bool = True)->tuple:
     """
-    Creates a conversion table for your data in order to streamline the lookup process (avoiding unnecessary future loading of the UMLS/pymedtermino)
-    Considers labels within the dataframe representing your dataset (e.g., MIMIC-III), creates synonym lists for the existing labels, returns them as a dataframe.
+    Creates synonym lists for a list of ICD9CM codes. Returns the codes for which synonyms could be created along with their synonym strings.
     """
-    gold_label_set = set()
-    label_lists = list(data_df.LABELS)
-    for label_list in label_lists:
-        gold_label_set = gold_label_set.union(set(str(label_list).split(";")))
-    gold_label_list = list(gold_label_set)
     syn_list = []
     viable_labels = []
-    for gold_label in gold_label_list:
-        syns = set_up_synonyms_ICD9(gold_label, True)
+    for label in labels:
+        syns = set_up_synonyms_ICD9(label, drop_unspecified)
         if syns:
             syn_list.append(syns[0][1])
-            viable_labels.append(gold_label)
+            viable_labels.append(label)
+    return viable_labels, syn_list
+
+def open_read_only_world(db_path:str):
+    """
+    Worker initialiser for the parallel setup -- opens a read-only connection to the pymedtermino database and rebinds the ontological variables of the worker process to it.
+    """
+    global PYM, CUI, ICD9CM, SNOMED, ICD10
+    world = World(filename = db_path, exclusive = False, read_only = True)
+    PYM = world.get_ontology("http://PYM/").load()
+    CUI = PYM["CUI"]
+    ICD9CM = PYM["ICD9CM"]
+    SNOMED = PYM["SNOMEDCT_US"]
+    ICD10 = PYM["ICD10"]
+
+def resolve_shard(shard:tuple)->tuple:
+    """
+    Resolves the synonyms of a shard of codes within a worker process, timing the shard.
+    """
+    shard_id, labels = shard
+    start = time.perf_counter()
+    viable_labels, syn_list = resolve_labels(labels)
+    return shard_id, len(labels), viable_labels, syn_list, time.perf_counter() - start
+
+def syndf_setup(data_df:pd.core.frame.DataFrame, n_jobs:int = 1, n_shards:int = None, db_path:str = "pym.sqlite3")->pd.core.frame.DataFrame:
+    """
+    Creates a conversion table for your data in order to streamline the lookup process (avoiding unnecessary future loading of the UMLS/pymedtermino)
+    Considers labels within the dataframe representing your dataset (e.g., MIMIC-III), creates synonym lists for the existing labels, returns them as a dataframe.
+    With n_jobs > 1 the labels are split into n_shards shards (by default 4 per worker) resolved concurrently by worker processes, each with its own read-only connection to db_path.
+    """
+    gold_label_set = set()
+    for label_list in data_df.LABELS:
+        gold_label_set.update(str(label_list).split(";"))
+    gold_label_list = sorted(gold_label_set)
+
+    if n_jobs <= 1:
+        viable_labels, syn_list = resolve_labels(gold_label_list)
+        return pd.DataFrame({"LABEL":viable_labels, "SYNONYMS":syn_list})
+
+    if n_shards is None:
+        n_shards = n_jobs * 4
+    # shards are interleaved to spread codes of similar chapters (and lookup cost) across workers
+    shards = [(i, gold_label_list[i::n_shards]) for i in range(n_shards)]
+    results = []
+    # workers are forked so that the module-level UMLS import is not re-run in each of them
+    with multiprocessing.get_context("fork").Pool(n_jobs, initializer = open_read_only_world, initargs = (db_path,)) as pool:
+        for result in tqdm(pool.imap_unordered(resolve_shard, shards), total = n_shards, unit = "shard"):
+            shard_id, n_labels, viable_labels, syn_list, elapsed = result
+            tqdm.write(f"shard {shard_id}: {len(viable_labels)}/{n_labels} codes with synonyms in {elapsed:.1f}s")
+            results.append(result)
+
+    # merging the shards in order keeps the output independent of worker scheduling
+    viable_labels = []
+    syn_list = []
+    for shard_id, n_labels, shard_labels, shard_syns, elapsed in sorted(results):
+        viable_labels += shard_labels
+        syn_list += shard_syns
     icd9syn_df = pd.DataFrame({"LABEL":viable_labels, "SYNONYMS":syn_list})
     return icd9syn_df 
     
@@ -142,6 +196,6 @@ if __name__ == "__main__":
     ner_output_df = pd.read_csv(ner_output_path)
     ner_output_df_with_syns = convert_code_and_populate_syns_cui(ner_output_df)
     data = pd.read_csv(disch_csv_path)
-    syns = (syndf_setup(data))
+    syns = (syndf_setup(data, n_jobs = multiprocessing.cpu_count()))
     syns.to_csv("syns.csv")
     ner_output_df_with_syns.to_csv('ner_output_with_syns.csv')